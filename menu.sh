@@ -147,7 +147,7 @@ function install_python3_and_deps() {
 			echo "Failed to install Python" >&2
 			exit 1
 		fi
-		pip3 install -U ruamel.yaml==0.16.12 blessed
+		pip3 install -U ruamel.yaml==0.16.12 'ruamel.yaml.clib>=0.2.7' blessed
 		if [ $? -eq 0 ]; then
 			PYAML_VERSION_GOOD="true"
 			BLESSED_GOOD="true"
@@ -16,17 +16,68 @@ messages will still only use the term "container".
 
 import argparse
 import copy
+import hashlib
 import logging
+import os
+import pickle
+import re
 import sys
-from collections import OrderedDict
+import tempfile
+import threading
+from collections import defaultdict
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from pathlib import Path
-from typing import List, Dict, Set, Union, Optional
+from types import MappingProxyType
+from typing import List, Dict, Mapping, Set, FrozenSet, Tuple, Union, Optional
 from ruamel.yaml import YAML
 from deps import consts
 
 logger = logging.getLogger(__name__)
-yaml = YAML()
+_thread_local = threading.local()
+
+def _yaml_loader(for_write: bool = False) -> YAML:
+    """Return the calling thread's YAML instance, as they keep parser state
+    and must not be shared between threads. If *for_write* the round-trip
+    loader preserving comments and formatting is returned, otherwise the safe
+    loader producing plain dicts and lists, which uses the libyaml C parser
+    from ruamel.yaml.clib when available."""
+    attr = 'yaml_rt' if for_write else 'yaml_safe'
+    loader = getattr(_thread_local, attr, None)
+    if loader is None:
+        loader = YAML() if for_write else YAML(typ='safe')
+        setattr(_thread_local, attr, loader)
+    return loader
+
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+"""Exact types of the immutable leaf values produced by the safe loader"""
+
+def _copy_tree(node):
+    """Return deep copy of *node*. Plain dicts and lists, as returned by the
+    safe loader, are copied directly, sharing their immutable scalars. Other
+    types, e.g. round-trip loaded CommentedMap, use copy.deepcopy()."""
+    node_type = type(node)
+    if node_type is dict:
+        return {key: _copy_tree(val) for key, val in node.items()}
+    if node_type is list:
+        return [_copy_tree(val) for val in node]
+    if node_type in _SCALAR_TYPES:
+        return node
+    return copy.deepcopy(node)
+
+_MOUNT_KEYS = frozenset(('volumes', 'devices'))
+"""List keys whose "HOST:CONTAINER" elements are split at the first ':'"""
+
+_MAPPING_LIST_KEYS = _MOUNT_KEYS | {'ports'}
+"""List keys whose elements are converted from list indices to maps"""
+
+_VARIABLE_RE = re.compile(r'%[^%\s]+%')
+"""Matches a template variable, e.g. %randomPassword%"""
+
+_PUBLIC_PORT_RE = re.compile(r'(\d+)(?:-(\d+))?:\d+(?:-\d+)?(?:/\w+)?\Z')
+"""Matches the host port or range of a "[bind_addr:]public:private[/proto]"
+ports entry"""
 
 class NestedDictList:
     """Operate on nested dict and list structures using a dot-separated key
@@ -53,6 +104,13 @@ class NestedDictList:
 
     Adding or removing PATHs is not supported. Only PATHs leading to
     leaf-values are valid.
+
+    Should several leaves convert to the same PATH, e.g. two "PW=..."
+    environment entries, get() and set() use the first one in document order.
+    The others are listed by shadowed_items().
+
+    The converted PATHs are indexed on first use. Changes made to the backing
+    dict other than through set() are not seen until invalidate() is called.
     """
     PathType = Union[str]
     LeafValueType = Union[str, int, float, bool]
@@ -60,162 +118,302 @@ class NestedDictList:
     def __init__(self, backing_dict: dict):
         """Construct instance to query and set values into *backing_dict*."""
         self.root = backing_dict
+        self.revision = 0
+        """Incremented by every set() and invalidate(), for caching values
+        derived from root"""
+        self.path_cache = None # type: Optional[Dict[str, tuple]]
+        """Index of converted paths built on first use, see __path_index()"""
+        self.shadowed_cache = [] # type: List[tuple[str, tuple]]
+        """(path, index entry) of leaves hidden by an earlier leaf with the
+        same converted path, built together with path_cache"""
+
+    def invalidate(self) -> None:
+        """Drop the path index and cached values derived from root, after
+        the backing dict has been modified directly."""
+        self.revision += 1
+        self.path_cache = None
 
     def get(self, path: PathType) -> "NestedDictList.LeafValueType":
         """Get value at converted path *path*."""
-        for key, val in self.items():
-            if key==path:
-                return val
-        raise KeyError(f'{path} not in {sorted(self)}')
+        index = self.__path_index()
+        entry = index.get(path)
+        if entry is None:
+            raise KeyError(f'{path} not in {len(index)} paths')
+        return entry[0]
 
     def set(self,
             path: PathType,
             new_value: LeafValueType) -> None:
         """Set value at converted path *path* to *new_value*."""
-        keys = path.split('.')
-        for item_path, _, parent, parent_key in NestedDictList.__items_converted(self.root):
-            # find item to set
-            if list(map(str,item_path)) == keys:
-                break
-        else:
-            # pylint false positive warning workaround
-            parent, parent_key = None, None # type: ignore
-            raise ValueError(f'No path={path} found in {sorted(self)}')
-        if isinstance(parent, dict):
+        entry = self.__path_index().get(path)
+        if entry is None:
+            raise ValueError(f'No path={path} found in {len(self)} paths')
+        _, parent, parent_key, item_path, affixes = entry
+        self.revision += 1
+        if affixes is None:
             parent[parent_key] = new_value
-            return
-        assert isinstance(parent_key, int) and isinstance(parent, list)
-        element = parent[parent_key]
-        # convert lists in ports and volumes from indices to maps
-        if isinstance(element, str) and len(keys)>2 and keys[-2] == 'ports':
-            _, key = element.rsplit(':', maxsplit=1)
-            parent[parent_key] = str(new_value) + ':' + key
-        elif isinstance(element, str) and len(keys)>2 \
-                and keys[-2] in ( 'volumes', 'devices'):
-            if element.count(':'):
-                _, key = element.split(':', maxsplit=1)
-                parent[parent_key] = str(new_value) + ':' + key
-            else:
-                parent[parent_key] = str(new_value) + ':' + keys[-1]
-        # resolve environment key=value pairs
-        elif isinstance(element, str) and '=' in element:
-            key, _ = element.split('=', maxsplit=1)
-            parent[parent_key] = key + '=' + str(new_value)
         else:
-            parent[parent_key] = new_value
-        return
+            # rebuild a converted list element around its unchanged parts
+            prefix, suffix = affixes
+            parent[parent_key] = f'{prefix}{new_value}{suffix}'
+        # update the index in place, unless the converted path changed too
+        new_path, value, affixes = NestedDictList.__convert(
+            item_path[:-1] + (parent_key,), parent[parent_key], parent)
+        if new_path == item_path and not isinstance(value, (dict, list)):
+            self.path_cache[path] = (value, parent, parent_key, item_path,
+                                  affixes)
+        else:
+            self.path_cache = None
 
     def items(self) -> Iterator[tuple[str, LeafValueType]]:
         """Generator of converted *path* and *value* pairs."""
-        for path, val, _, _ in NestedDictList.__items_converted(self.root):
-            yield ('.'.join(map(str,path)), val)
+        for path, entry in self.__path_index().items():
+            yield (path, entry[0])
+
+    def shadowed_items(self) -> Iterator[tuple[str, LeafValueType]]:
+        """Generator of converted *path* and *value* pairs of the leaves not
+        reachable by get() or set(), as an earlier leaf has the same *path*."""
+        self.__path_index()
+        for path, entry in self.shadowed_cache:
+            yield (path, entry[0])
 
     def __str__(self):
         return sorted(self.items())
 
     def __len__(self):
-        return len(list(self.items()))
+        return len(self.__path_index())
 
     def __iter__(self):
-        for key, _ in self.items():
-            yield key
+        return iter(self.__path_index())
+
+    def __contains__(self, path):
+        return path in self.__path_index()
+
+    def __path_index(self) -> Dict[str, tuple]:
+        """Return dict of converted *path* -> tuple(value, value_parent,
+        parent_key, item_path, affixes), walking the backing dict only when
+        the previous index has been invalidated by a set()."""
+        if self.path_cache is None:
+            index = {} # type: Dict[str, tuple]
+            shadowed = [] # type: List[tuple[str, tuple]]
+            for item_path, val, parent, parent_key, affixes in \
+                    NestedDictList.__items_converted(self.root):
+                # interned so lookups with keys taken from another view of
+                # the same template, e.g. in with_variables(), match by
+                # identity
+                path = sys.intern('.'.join(map(str,item_path)))
+                entry = (val, parent, parent_key, item_path, affixes)
+                if path in index:
+                    shadowed.append((path, entry))
+                else:
+                    index[path] = entry
+            self.path_cache = index
+            self.shadowed_cache = shadowed
+        return self.path_cache
 
     __RootType = Union[dict,list,LeafValueType]
     __KeyType = Union[str,int] # str for dict key or int for list index
-    __KeyListType = List[__KeyType] # Path before joining to '.'-separated
+    __KeyTupleType = Tuple[__KeyType, ...] # Path before joining with '.'
+    # (prefix, suffix) around the value in a converted list element
+    __AffixesType = Optional[Tuple[str, str]]
 
     @staticmethod
     def __items_converted(root: __RootType) -> \
-            Iterator[tuple[__KeyListType,
-                           LeafValueType,
-                           Union[dict,list],
-                           __KeyType]]:
-        """Converted deep-walk of *root* -> Iterator(tuple(path, value,
-        value_parent, parent_key)). Returned iterator lists all leaf values.
-
-        As *path*s and *value*s are converted, the original key is provided as
-        *parent_key*. This can be used to modify the value in the backing
-        dict or list: *value_parent*"""
-        for path, val, parent in NestedDictList.__items(root):
-            if isinstance(parent, dict):
-                yield (path, val, parent, path[-1])
-            # convert lists in ports, volumes and devices from indices to maps
-            elif isinstance(val, str) and len(path)>2 and path[-2] == 'ports':
-                value, key = val.rsplit(':', maxsplit=1)
-                yield (path[:-1] + [key], value, parent, path[-1])
-            elif isinstance(val, str) and len(path)>2 and path[-2] in (
-                'volumes', 'devices'):
-                if val.count(':'):
-                    value, key = val.split(':', maxsplit=1)
-                    yield (path[:-1] + [key], value, parent, path[-1])
+            List[tuple[__KeyTupleType,
+                       LeafValueType,
+                       Union[dict,list],
+                       __KeyType,
+                       __AffixesType]]:
+        """Converted deep-walk of *root* -> list(tuple(path, value,
+        value_parent, parent_key, affixes)) for all the leaf values in the
+        structure, in document order.
+
+        Returned *path* is the tuple of dict keys or list indices to traverse
+        the nested structure of *root* to the the leaf *value*. *value_parent*
+        is the dict or list that contained the leaf *value*. As *path*s and
+        *value*s are converted, the original key is provided as *parent_key*.
+        This can be used to modify the value in the backing dict or list:
+        *value_parent*. *affixes* is the (prefix, suffix) to put around a new
+        value to rebuild a converted element, or None if it wasn't
+        converted."""
+        if not isinstance(root, (dict, list)):
+            raise ValueError(f'{root} must be a dict or a list')
+        result = []
+        # (remaining (key, child) pairs, path, parent) of containers being
+        # walked, the innermost last. Leaves are handled without stacking.
+        stack = [(NestedDictList.__children(root), (), root)]
+        while stack:
+            children, prefix, parent = stack[-1]
+            # only string elements of lists may need conversion
+            in_list = isinstance(parent, list)
+            for key, val in children:
+                path = prefix + (key,)
+                # exact type test first, isinstance() for round-trip types
+                if type(val) not in _SCALAR_TYPES \
+                        and isinstance(val, (dict, list)):
+                    stack.append((NestedDictList.__children(val), path, val))
+                    break
+                if in_list and isinstance(val, str):
+                    converted_path, val, affixes = NestedDictList.__convert(
+                        path, val, parent)
+                    result.append((converted_path, val, parent, key, affixes))
                 else:
-                    # docker "undocumented feature" key and value assumed the same
-                    yield (path[:-1] + [val], val, parent, path[-1])
-            # resolve environment key=value pairs
-            elif isinstance(val, str) and '=' in val and len(path)>0:
-                key, value = val.split('=', maxsplit=1)
-                yield (path[:-1] + [key], value, parent, path[-1])
+                    result.append((path, val, parent, key, None))
             else:
-                yield (path, val, parent, path[-1])
+                stack.pop()
+        return result
 
+    @staticmethod
+    def __children(collection: Union[dict,list]) -> Iterator[tuple]:
+        """Iterator of (key, value) pairs of a dict or (index, value) pairs of a
+        list."""
+        if isinstance(collection, dict):
+            return iter(collection.items())
+        return enumerate(collection)
 
     @staticmethod
-    def __items(root: __RootType,
-                key_prefix: __KeyListType = None,
-                parent_collection: Union[dict,list] = None) -> \
-            Iterator[tuple[__KeyListType,
-                           LeafValueType,
-                           Union[dict,list]]]:
-        """Deep-walk into nested dicts and lists of *root* ->
-        iterable(tuple(path, value, value_parent)) for all the leaf values in
-        the structure. Parameter *key_prefix* is the keys that have been needed
-        to reach the current recursion level.
-
-        Returned *path* is the list of dict keys or list indices to traverse
-        the nested structure of *root* to the the leaf *value*. *value_parent*
-        is the dict or list that contained the leaf *value*.
-        """
-        if not key_prefix:
-            key_prefix = []
-        if isinstance(root, dict):
-            for key, val in root.items():
-                yield from NestedDictList.__items(val, key_prefix+[key], root)
-            return
-        if isinstance(root, list):
-            for index, val in enumerate(root):
-                yield from NestedDictList.__items(val, key_prefix+[index], root)
-            return
-        if not parent_collection:
-            raise ValueError(f'{root} with key_prefix={key_prefix}'
-                             f' must not have empty parent_collection')
-        yield (key_prefix, root, parent_collection)
+    def __convert(path: __KeyTupleType,
+                  val: LeafValueType,
+                  parent: Union[dict,list]) -> \
+            tuple[__KeyTupleType, LeafValueType, __AffixesType]:
+        """Return tuple(converted path, converted value, affixes) of the leaf
+        *val* at *path* in its containing *parent*."""
+        if isinstance(parent, dict) or not isinstance(val, str):
+            return path, val, None
+        list_key = path[-2] if len(path)>2 else None
+        # convert lists in ports, volumes and devices from indices to maps
+        if list_key not in _MAPPING_LIST_KEYS:
+            if '=' not in val:
+                return path, val, None
+            # resolve environment key=value pairs
+            key, _, value = val.partition('=')
+            return path[:-1] + (key,), value, (f'{key}=', '')
+        if list_key == 'ports':
+            value, _, key = val.rpartition(':')
+        else:
+            value, sep, key = val.partition(':')
+            if not sep:
+                # docker "undocumented feature" key and value assumed the same
+                key = value
+        return path[:-1] + (key,), value, ('', f':{key}')
 
 class TemplateFile:
     """Represents a docker-compose.yml or a template's service.yml"""
-    def __init__(self, service_yml_path: Path):
+
+    cache_dir = None # type: Optional[Path]
+    """Folder to cache parsed read-only files in, None to always parse"""
+
+    CACHE_FORMAT = 2
+    """Version of the cache_dir pickle contents, bump when changing them"""
+
+    NO_VARIABLES = MappingProxyType({}) # type: Mapping[str, str]
+    """variables() of a template without any"""
+
+    def __init__(self, service_yml_path: Path, for_write: bool = False):
+        """Load *service_yml_path*. Use *for_write* when the file will be
+        written back, to preserve its comments and formatting."""
         self.service_yml_path = service_yml_path
         self.name = str(self)
-        self.bare_yml = yaml.load(self.service_yml_path)
-        self.yml_view = NestedDictList(self.bare_yml)
-        logger.debug('ServiceTemplate(%s) loaded with %i elements (%i roots)',
-                     self.name, len(self.yml_view), len(self.bare_yml.keys()))
-        #yaml.dump(self.bare_yml, sys.stderr)
+        # may_have_variables is False if the loaded bare_yml can't contain '%'
+        if for_write or TemplateFile.cache_dir is None:
+            self.bare_yml, self.may_have_variables = self.__parse(for_write)
+        else:
+            self.bare_yml, self.may_have_variables = self.__load_cached(
+                TemplateFile.cache_dir)
+        self.variables_cache = None \
+            # type: Optional[tuple[int, Dict[str, str]]]
+        """(yml_view revision, result) of the last variables() call"""
+        self.public_ports_cache = None \
+            # type: Optional[tuple[int, FrozenSet[int]]]
+        """(yml_view revision, result) of the last public_ports() call"""
+        if logger.isEnabledFor(logging.DEBUG):
+            # only walk the yml for the element count when it's printed
+            logger.debug('ServiceTemplate(%s) loaded with %i elements'
+                         ' (%i roots)', self.name, len(self.yml_view),
+                         len(self.bare_yml.keys()))
+        #_yaml_loader(True).dump(self.bare_yml, sys.stderr)
+
+    def __parse(self, for_write: bool = False) -> Tuple[dict, bool]:
+        """Parse the file -> tuple(parsed yml, whether it may contain
+        variables). Only files without any '%' or '\\' characters can't: an
+        escape sequence e.g. "\\x25" in a double-quoted scalar is parsed to a
+        '%'."""
+        raw = self.service_yml_path.read_bytes()
+        return _yaml_loader(for_write).load(raw), \
+            b'%' in raw or b'\\' in raw
+
+    def __load_cached(self, cache_dir: Path) -> Tuple[dict, bool]:
+        """Return the __parse() result from a pickle in *cache_dir* if it was
+        saved from the current version of the file, otherwise parse and save
+        it."""
+        stat = self.service_yml_path.stat()
+        version = (stat.st_mtime_ns, stat.st_size)
+        path_hash = hashlib.blake2b(
+            str(self.service_yml_path.resolve()).encode(),
+            digest_size=16).hexdigest()
+        cache_file = cache_dir / f'{path_hash}.pickle'
+        try:
+            with open(cache_file, 'rb') as cached:
+                cache_format, cached_version, (bare_yml, flag) = \
+                    pickle.load(cached)
+            if cache_format == TemplateFile.CACHE_FORMAT \
+                    and cached_version == version:
+                return bare_yml, flag
+        except FileNotFoundError:
+            pass # not cached yet
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError,
+                ValueError, AttributeError, ImportError) as err:
+            # unreadable, corrupt, or a different layout or class of contents
+            logger.debug('Ignoring cache of %s: %r', self.service_yml_path,
+                         err)
+        parsed = self.__parse()
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # write and rename, so concurrent readers never see partial files
+            fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as cached:
+                    pickle.dump((TemplateFile.CACHE_FORMAT, version, parsed),
+                                cached)
+                os.replace(temp_file, cache_file)
+            except BaseException:
+                os.unlink(temp_file)
+                raise
+        except OSError as err:
+            logger.debug('Not caching %s: %s', self.service_yml_path, err)
+        return parsed
+
+    @cached_property
+    def yml_view(self) -> NestedDictList:
+        """Converted path access to bare_yml, created on first use. Loading
+        templates e.g. for port conflict checks never walks the yml."""
+        return NestedDictList(self.bare_yml)
 
     def __str__(self):
         if self.service_yml_path.name == 'service.yml':
             return self.service_yml_path.parent.name
         return self.service_yml_path.name
 
-    def public_ports(self) -> Set[int]:
+    def public_ports(self) -> FrozenSet[int]:
         """Return set of host ports exposed by this template, that may conflict
-        with other services."""
+        with other services. The set is shared between calls, hence frozen."""
         # TODO: add parseable comment "network_mode: host" service templates
-        # port may be "bind_addr:public:private" or "public:private"
-        return {port.split(':')[-2]
-                for service in self.bare_yml.values()
-                for port in service.get('ports', []) }
-
-    def variables(self) -> dict[str, str]:
+        # cached until the yml_view is modified
+        revision = self.yml_view.revision
+        if self.public_ports_cache is None \
+                or self.public_ports_cache[0] != revision:
+            ports = set() # type: Set[int]
+            for service in self.bare_yml.values():
+                for port in service.get('ports', ()):
+                    # a bare private port gets a random public port
+                    match = _PUBLIC_PORT_RE.search(str(port))
+                    if match:
+                        first, last = match.group(1, 2)
+                        ports.update(range(int(first), int(last or first)+1))
+            self.public_ports_cache = (revision, frozenset(ports))
+        return self.public_ports_cache[1]
+
+    def variables(self) -> Mapping[str, str]:
         """Return paths to dynamic variables defined in the template. These are
         the variable keys to use in a with_variables() call to replace them.
 
@@ -224,74 +422,159 @@ class TemplateFile:
         elements indices leading to such entries. Certain list elements are
         converted from their list&index to better reflect their semantic
         functions in docker-compose. This conversion is done as documented in
-        the NestedDictList-class."""
-        return {path: value
-            for path, value in self.yml_view.items()
-            if isinstance(value, str) and value.count('%') >= 2}
+        the NestedDictList-class.
+
+        The returned mapping is read-only, as it is shared between calls."""
+        # cached until the yml_view is modified
+        revision = self.yml_view.revision
+        if revision == 0 and not self.may_have_variables:
+            return TemplateFile.NO_VARIABLES # no '%' in the file as loaded
+        if self.variables_cache is None or self.variables_cache[0] != revision:
+            # shadowed leaves too, they can't be replaced but must be reported
+            self.variables_cache = (revision, {path: value
+                for items in (self.yml_view.items(),
+                              self.yml_view.shadowed_items())
+                for path, value in items
+                if isinstance(value, str) and '%' in value
+                and _VARIABLE_RE.search(value)})
+        # the memo stays a plain dict, as mappingproxy can't be deep copied
+        return MappingProxyType(self.variables_cache[1])
 
     def with_variables(self, variables: Dict[str, str]) -> 'TemplateFile':
         """Return deep copy of the template replacing all variables according
         to their paths. Will raise ValueError if there are unreplaced
         variables left."""
-        result = copy.deepcopy(self)
+        own_variables = self.variables()
+        # fail before copying anything, if no replacement was given
+        unreplaced = {path: own_variables[path]
+                      for path in own_variables.keys() - variables.keys()}
+        if unreplaced:
+            raise ValueError(f'Unreplaced variables {unreplaced}')
+        result = self.__clone()
         for path, val in variables.items():
             if path in result.yml_view:
                 result.yml_view.set(path, val)
-        unreplaced = result.variables()
+                # a replacement may itself be a variable
+                if isinstance(val, str) and _VARIABLE_RE.search(val):
+                    unreplaced[path] = val
+        # set() can't reach a leaf shadowed by an earlier one with its path
+        for path, value in result.yml_view.shadowed_items():
+            if isinstance(value, str) and _VARIABLE_RE.search(value):
+                unreplaced[path] = value
         if unreplaced:
             raise ValueError(f'Unreplaced variables {unreplaced}')
         return result
 
+    def __clone(self) -> 'TemplateFile':
+        """Return a copy with its own deep copy of bare_yml, without reloading
+        the file. Derived state, e.g. yml_view, is recreated when used."""
+        result = TemplateFile.__new__(TemplateFile)
+        result.service_yml_path = self.service_yml_path
+        result.name = self.name
+        result.bare_yml = _copy_tree(self.bare_yml)
+        # set() may have added a '%' to the tree being copied
+        result.may_have_variables = self.may_have_variables \
+            or self.yml_view.revision != 0
+        result.variables_cache = None
+        result.public_ports_cache = None
+        return result
+
 class Templates:
     """
     Access and actions to the ".templates" folder content.
     """
 
-    KNOWN_PORT_CONFLICTS = {53,}
+    KNOWN_PORT_CONFLICTS = frozenset((53,))
 
-    def __init__(self, template_folder_path: Path):
-        """All templates, per default loads everyting from .templates"""
-        self.templates = Templates.__load_templates(template_folder_path)
-        """Currently loaded TemplateFile:s"""
-        self.env_template = Templates.__load_env(template_folder_path)
-        """Common base TemplateFile, if available."""
+    PARALLEL_LOAD_MIN = 8
+    """Template count from which templates are loaded using a thread pool"""
 
-    @staticmethod
-    def __load_env(template_folder_path: Path) -> Optional[TemplateFile]:
-        env_file = template_folder_path / 'env.yml'
+    PARALLEL_LOAD_MAX_WORKERS = 8
+    """Thread pool size limit, the pool isn't used on single core machines"""
+
+    def __init__(self, template_folder_path: Path):
+        """All templates, per default everything from .templates. Templates are
+        loaded on first use, see get() and load_all()."""
+        self.template_paths = Templates.__find_templates(template_folder_path)
+        """Available template names and their service.yml paths"""
+        self.loaded = {} # type: Dict[str, TemplateFile]
+        """Templates loaded so far by name, use get() or load_all()"""
+        self.template_folder_path = template_folder_path
+
+    @cached_property
+    def env_template(self) -> Optional[TemplateFile]:
+        """Common base TemplateFile, if available. Loaded on first use."""
+        env_file = self.template_folder_path / 'env.yml'
         if env_file.exists():
             return TemplateFile(env_file)
         return None
 
+    def get(self, name: str) -> TemplateFile:
+        """Return the TemplateFile of template *name*, loading it if needed.
+        Raises KeyError for an unknown *name*."""
+        template = self.loaded.get(name)
+        if template is None:
+            template = TemplateFile(self.template_paths[name])
+            self.loaded[name] = template
+        return template
+
+    def load_all(self) -> Dict[str, TemplateFile]:
+        """Return all templates by name, loading those not yet loaded."""
+        missing = [name for name in self.template_paths
+                   if name not in self.loaded]
+        service_files = [self.template_paths[name] for name in missing]
+        workers = min(Templates.PARALLEL_LOAD_MAX_WORKERS, os.cpu_count() or 1)
+        if len(missing) < Templates.PARALLEL_LOAD_MIN or workers < 2:
+            self.loaded.update(
+                zip(missing, map(TemplateFile, service_files)))
+        else:
+            # overlap reading the files, mostly helps with slow SD-cards
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                self.loaded.update(zip(
+                    missing, executor.map(TemplateFile, service_files)))
+        return {name: self.loaded[name] for name in self.template_paths}
+
     @staticmethod
-    def __load_templates(template_folder_path: Path) \
-            -> Dict[str,TemplateFile]:
+    def __find_templates(template_folder_path: Path) -> Dict[str,Path]:
         """Scan for ServiceTemplate:s from every subfolder of
-        template_folder_path to loaded templates"""
+        template_folder_path -> dict(template name, service.yml path)"""
         if not template_folder_path.exists():
             raise ValueError(f"Templates directory doesn't exist: "
                              f"{template_folder_path}")
-        service_glob = sorted(Path(template_folder_path).glob('*/service.yml'))
-        if len(service_glob)==0:
-            raise ValueError(f"No templates found in {service_glob}")
-        return {service_file.parent.name: TemplateFile(service_file)
-                for service_file in service_glob}
+        found = dict(Templates.__scan_templates(template_folder_path))
+        if len(found)==0:
+            raise ValueError(f"No templates found in {template_folder_path}")
+        return found
+
+    @staticmethod
+    def __scan_templates(template_folder_path: Path) \
+            -> List[Tuple[str, Path]]:
+        """Return sorted list of tuple(template name, service.yml path) for
+        subfolders of *template_folder_path* containing a service.yml. Same as
+        globbing '*/service.yml', but reads the directory only once."""
+        found = []
+        with os.scandir(template_folder_path) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                service_file = os.path.join(entry.path, 'service.yml')
+                if os.path.isfile(service_file):
+                    found.append((entry.name, Path(service_file)))
+        found.sort()
+        return found
 
     def conflicting_ports(self, verbose=True) -> Dict[int, Set[str]]:
         """Return dict with ports as keys and values as a set of service
         names."""
-        service_ports = {name: template.public_ports()
-                 for name, template in self.templates.items()}
-        port_services = {} # type: Dict[int, Set[str]]
-        for service, ports in service_ports.items():
-            for port in ports:
-                port_set = port_services.setdefault(int(port), set())
-                port_set.add(service)
+        port_services = defaultdict(set) # type: Dict[int, Set[str]]
+        for name, template in self.load_all().items():
+            for port in template.public_ports():
+                port_services[port].add(name)
         conflicts = {port: services for port, services in port_services.items()
                      if len(services)>1}
         if verbose:
             for port, services in conflicts.items():
-                if int(port) in Templates.KNOWN_PORT_CONFLICTS:
+                if port in Templates.KNOWN_PORT_CONFLICTS:
                     logging.info('Services using port %s: %s but users'
                                  ' are meant to pick only one of these',
                                  port, services)
@@ -308,17 +591,17 @@ class Stack:
     def __init__(self, docker_compose: Path, templates_folder: Path):
         """Load a docker-compose.yml file as the current state with templates
         loaded for services loaded from *templates_folder*"""
-        self.current_state = TemplateFile(Path(docker_compose))
+        self.current_state = TemplateFile(Path(docker_compose), for_write=True)
         self.templates = Templates(templates_folder)
 
-    def selected_templates(self) -> Set[str]:
-        """Return templates selected in the current docker-compose.yml. Some
-        templates may include multiple docker-services, but a template is
-        considered selected, as long as a there is a service with the same name
-        as the template."""
-        services = self.current_state.bare_yml['services'].keys()
-        templates = self.templates.templates.keys()
-        return services & templates
+    def selected_templates(self) -> List[str]:
+        """Return templates selected in the current docker-compose.yml, in the
+        order of its services. Some templates may include multiple
+        docker-services, but a template is considered selected, as long as a
+        there is a service with the same name as the template."""
+        templates = self.templates.template_paths
+        return [service for service in self.current_state.bare_yml['services']
+                if service in templates]
 
     def add_template(self, template: TemplateFile,
                      append_prefix="service") -> None:
@@ -328,30 +611,31 @@ class Stack:
             if append_prefix in add_parent:
                 add_parent = add_parent[append_prefix]
             else:
-                add_parent = OrderedDict()
+                add_parent = {}
                 self.current_state.bare_yml[append_prefix] = add_parent
         # actual add
         # FIXME: password replacements
         # save
+        # bare_yml was modified directly, not through the yml_view
+        self.current_state.yml_view.invalidate()
 
     def write_docker_compose(self, backup=True):
         """Write in-memory changes to docker-compose.yml"""
         # TODO
 
-def check_op(args):
+def check_op(stack, args):
     """Check all templates for problems and exit."""
     if args.templates:
         print('ERROR: must not specify any containers for checking',
               file=sys.stderr)
         sys.exit(99)
-    templates = Templates(Path(consts.templatesDirectory))
-    conflicts = templates.conflicting_ports(verbose=True)
+    conflicts = stack.templates.conflicting_ports(verbose=True)
     sys.exit(int(len(conflicts) > 0))
 
 def show_op(stack, args):
     """List all available templates"""
     if 'ALL' in args.templates:
-        for template in stack.templates.templates.keys():
+        for template in stack.templates.template_paths.keys():
             print(template)
 
 def list_op(stack, args):
@@ -360,20 +644,21 @@ def list_op(stack, args):
         logger.warning('--list ignores CONTAINER_NAME arguments.')
     for template_name in sorted(stack.selected_templates()):
         print(template_name)
-        template = stack.templates.templates[template_name]
+        template = stack.templates.get(template_name)
         for k, v in template.variables().items():
             if not 'Password' in v:
                 continue
-            if 'services.'+k in stack.current_state.yml_view:
-                pw = stack.current_state.yml_view.get("services."+k)
-                print(f'- {k}: {pw}')
-            else:
+            try:
+                pw = stack.current_state.yml_view.get('services.'+k)
+            except KeyError:
                 print(f'- {k} is not set')
+                continue
+            print(f'- {k}: {pw}')
 
 def add_op(stack, args):
     """Add templates to the stack"""
     for template_name in args.templates:
-        template = stack.templates.templates[template_name]
+        template = stack.templates.get(template_name)
         stack.add_template(template)
     # After all templates are added apply variable replacement, as some vars
     # may reference services from other templates.
@@ -467,6 +752,7 @@ def main():
     init_logger(args.verbose)
     logger.debug("Program arguments: %s", args)
     if args.op:
+        TemplateFile.cache_dir = Path(consts.tempDirectory) / 'template_cache'
         stack = Stack(Path('docker-compose.yml'), Path('.templates'))
         args.op(stack, args)
     else:
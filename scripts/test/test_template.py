@@ -1,6 +1,12 @@
 """Tests for template.py"""
+import copy
+import pickle
+import shutil
+import tempfile
 import unittest
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 import template
 
 class StackTestCase(unittest.TestCase):
@@ -12,14 +18,73 @@ class StackTestCase(unittest.TestCase):
 
     def test_selected_templates(self):
         selected = self.stack.selected_templates()
-        self.assertSetEqual( selected, {'mockservice',})
+        self.assertListEqual( selected, ['mockservice',])
+
+    def test_check_op(self):
+        args = SimpleNamespace(templates=[])
+        with self.assertRaises(SystemExit) as exited:
+            template.check_op(self.stack, args)
+        self.assertEqual(exited.exception.code, 0) # no conflicts
+
+class TemplatesTestCase(unittest.TestCase):
+    """Templates class tests"""
+    def setUp(self):
+        self.templates = template.Templates(
+            Path('scripts/test/templates_test/'))
+
+    def test_template_paths(self):
+        self.assertListEqual(list(self.templates.template_paths),
+                             ['alpha', 'beta', 'delta', 'gamma'])
+
+    def test_get(self):
+        alpha = self.templates.get('alpha')
+        self.assertEqual(alpha.name, 'alpha')
+        self.assertIs(self.templates.get('alpha'), alpha) # loaded once
+        self.assertRaises(KeyError, lambda: self.templates.get('none'))
+
+    def test_load_all(self):
+        alpha = self.templates.get('alpha')
+        loaded = self.templates.load_all()
+        self.assertListEqual(list(loaded), ['alpha', 'beta', 'delta', 'gamma'])
+        self.assertIs(loaded['alpha'], alpha)
+        self.assertIs(self.templates.get('beta'), loaded['beta'])
+
+    def test_load_all_parallel(self):
+        with mock.patch.object(template.Templates, 'PARALLEL_LOAD_MIN', 2), \
+                mock.patch('os.cpu_count', return_value=4), \
+                mock.patch.object(template, 'ThreadPoolExecutor',
+                                  wraps=template.ThreadPoolExecutor) as pool:
+            loaded = self.templates.load_all()
+        pool.assert_called_once()
+        self.assertEqual({name: t.bare_yml for name, t in loaded.items()},
+                         {name: template.TemplateFile(path).bare_yml
+                          for name, path in
+                          self.templates.template_paths.items()})
+
+    def test_conflicting_ports(self):
+        with self.assertLogs(level='INFO') as logs:
+            conflicts = self.templates.conflicting_ports(verbose=True)
+        self.assertDictEqual(conflicts, {8080: {'alpha', 'beta'},
+                                         53: {'alpha', 'gamma'}})
+        self.assertEqual(sorted(record.levelname for record in logs.records),
+                         ['INFO', 'WARNING']) # 53 is a known conflict
 
 class TemplateFileTestCase(unittest.TestCase):
     """TemplateFile class tests"""
-    def setUp(self):
-        self.t = template.TemplateFile(
+    @classmethod
+    def setUpClass(cls):
+        cls.template = template.TemplateFile(
             Path('scripts/test/template_test/mockservice/service.yml'))
 
+    def setUp(self):
+        # tests may modify their template, copying is cheaper than parsing
+        self.t = copy.deepcopy(self.template)
+
+    def test_safe_loaded(self):
+        # read-only templates use the safe loader, not round-trip CommentedMap
+        self.assertIs(type(self.t.bare_yml), dict)
+        self.assertIs(type(self.t.bare_yml['mockservice']['ports']), list)
+
     def test_yml_view(self):
         view = sorted(self.t.yml_view.items())
         self.assertIn(('mockservice.privileged', True,), view)
@@ -27,13 +92,54 @@ class TemplateFileTestCase(unittest.TestCase):
         self.assertIn(('mockservice.devices./dev/null','/dev/null'), view)
 
     def test_public_ports(self):
-        self.assertEqual(self.t.public_ports(), {'8089', '53'})
+        self.assertEqual(self.t.public_ports(), {8089, 53})
+
+    def test_public_port_ranges(self):
+        with tempfile.TemporaryDirectory() as folder:
+            yml = Path(folder) / 'service.yml'
+            yml.write_text('ranged:\n  ports:\n'
+                           '    - "9090-9092:8080-8082/udp"\n'
+                           '    - "3000"\n')
+            self.assertEqual(template.TemplateFile(yml).public_ports(),
+                             {9090, 9091, 9092})
+
+    def test_escaped_variable(self):
+        with tempfile.TemporaryDirectory() as folder:
+            yml = Path(folder) / 'service.yml'
+            yml.write_text('svc:\n  environment:\n'
+                           '    - "PW=\\x25pw\\x25"\n', encoding='utf-8')
+            self.assertEqual(template.TemplateFile(yml).variables(),
+                             {'svc.environment.PW': '%pw%'})
+
+    def test_duplicate_variable_paths(self):
+        with tempfile.TemporaryDirectory() as folder:
+            yml = Path(folder) / 'service.yml'
+            yml.write_text('svc:\n  environment:\n'
+                           '    - PW=%a%\n'
+                           '    - PW=%b%\n', encoding='utf-8')
+            duplicated = template.TemplateFile(yml)
+            self.assertEqual(duplicated.variables(),
+                             {'svc.environment.PW': '%b%'})
+            # only the first PW is reachable, the second is left unreplaced
+            self.assertRaises(ValueError, lambda: duplicated.with_variables(
+                {'svc.environment.PW': 'x'}))
 
     def test_variable_items(self):
         self.assertEqual(
             self.t.variables(),
             {'mockservice.environment.PW': '%randomPassword%'})
 
+    def test_deepcopy_after_variables(self):
+        self.test_variable_items() # memoize variables
+        copied = copy.deepcopy(self.t)
+        self.assertEqual(copied.variables(), self.t.variables())
+        self.assertIsNot(copied.bare_yml, self.t.bare_yml)
+
+    def test_variables_after_set(self):
+        self.test_variable_items() # cache variables before modification
+        self.t.yml_view.set('mockservice.environment.PW', 'testpass')
+        self.assertEqual(self.t.variables(), {})
+
     def test_with_variables(self):
         res = self.t.with_variables(
             {'mockservice.environment.PW': 'testpass' })
@@ -42,6 +148,64 @@ class TemplateFileTestCase(unittest.TestCase):
         self.test_variable_items() # check that original is unchanged
         self.assertRaises(ValueError, lambda: self.t.with_variables({}))
 
+class TemplateFileCacheTestCase(unittest.TestCase):
+    """TemplateFile pickle cache tests"""
+    def setUp(self):
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        self.yml = folder / 'mockservice' / 'service.yml'
+        self.yml.parent.mkdir()
+        self.yml.write_bytes(Path(
+            'scripts/test/template_test/mockservice/service.yml').read_bytes())
+        self.cache_dir = folder / 'cache'
+        template.TemplateFile.cache_dir = self.cache_dir
+
+    def tearDown(self):
+        template.TemplateFile.cache_dir = None
+
+    def load_without_parsing(self):
+        parse = mock.Mock(side_effect=AssertionError('parsed'))
+        with mock.patch.object(template.TemplateFile,
+                               '_TemplateFile__parse', parse):
+            return template.TemplateFile(self.yml)
+
+    def cache_files(self):
+        return list(self.cache_dir.iterdir())
+
+    def test_warm_hit(self):
+        parsed = template.TemplateFile(self.yml)
+        self.assertEqual(len(self.cache_files()), 1) # no leftover temp files
+        cached = self.load_without_parsing()
+        self.assertEqual(cached.bare_yml, parsed.bare_yml)
+        self.assertEqual(cached.variables(), parsed.variables())
+
+    def test_changed_file_reparsed(self):
+        template.TemplateFile(self.yml)
+        with open(self.yml, 'a', encoding='utf-8') as yml:
+            yml.write('added:\n  image: added\n')
+        self.assertIn('added', template.TemplateFile(self.yml).bare_yml)
+        self.assertIn('added', self.load_without_parsing().bare_yml)
+
+    def test_corrupt_cache_ignored(self):
+        expected = template.TemplateFile(self.yml).bare_yml
+        cache_file, = self.cache_files()
+        for corrupt in (b'garbage', pickle.dumps(None),
+                        pickle.dumps((1, 2, 3)), b''):
+            cache_file.write_bytes(corrupt)
+            self.assertEqual(template.TemplateFile(self.yml).bare_yml,
+                             expected)
+        self.load_without_parsing() # rewritten by the last load
+
+    def test_old_format_reparsed(self):
+        template.TemplateFile(self.yml)
+        cache_file, = self.cache_files()
+        stat = self.yml.stat()
+        # (version, bare_yml) entry from before the variables flag was cached,
+        # with two root keys that would unpack as (bare_yml, flag)
+        cache_file.write_bytes(pickle.dumps(
+            ((stat.st_mtime_ns, stat.st_size), {'a': 1, 'b': 2})))
+        self.assertIn('mockservice', template.TemplateFile(self.yml).bare_yml)
+
 class NestedDictListTestCase(unittest.TestCase):
     """NestedDictList class tests"""
 
@@ -85,6 +249,12 @@ class NestedDictListTestCase(unittest.TestCase):
         self.assertEqual( self.query.get('pihole.privileged'), True)
         self.assertEqual( len(self.query), self.leaf_count)
 
+    def test_contains(self):
+        self.assertIn('pihole.ports.80', self.query)
+        self.assertIn('pihole.volumes./etc/timezone:ro', self.query)
+        self.assertNotIn('pihole.ports.8080', self.query)
+        self.assertNotIn('pihole', self.query)
+
     def test_set(self):
         self.query.set('version', 3.1)
         self.assertEqual( self.query.get('version'), 3.1)
@@ -108,3 +278,45 @@ class NestedDictListTestCase(unittest.TestCase):
         self.assertEqual( self.query.get('pihole.privileged'), False)
         self.assertRaises(ValueError, lambda: self.query.set('service.none.existant', 0))
         self.assertEqual( len(self.query), self.leaf_count) # no new elements
+
+    def test_shadowed_items(self):
+        self.query.root['pihole']['ports'].append('8081:80')
+        self.query.invalidate()
+        self.assertEqual(self.query.get('pihole.ports.80'), '127.0.0.1:8080')
+        self.assertListEqual(list(self.query.shadowed_items()),
+                             [('pihole.ports.80', '8081')])
+        self.assertEqual(len(self.query), self.leaf_count)
+
+    def test_invalidate(self):
+        revision = self.query.revision
+        self.assertNotIn('added.image', self.query) # index built
+        self.query.root['added'] = {'image': 'added/image'}
+        self.query.invalidate()
+        self.assertEqual(self.query.get('added.image'), 'added/image')
+        self.assertEqual(len(self.query), self.leaf_count + 1)
+        self.assertGreater(self.query.revision, revision)
+
+    def test_set_many_walks_once(self):
+        query = template.NestedDictList({
+            f'service{i}': {
+                'environment': ['TZ=Etc/UTC', f'PW=%password{i}%'],
+                'ports': [f'{8000+i}:80'],
+                'volumes': [f'./volumes/service{i}:/data'],
+                'networks': ['iotstack'],
+                'restart': 'unless-stopped',
+                'image': f'service{i}:latest',
+                'privileged': False,
+                'dns': ['127.0.0.1', '1.1.1.1']}
+            for i in range(50)})
+        walk = mock.Mock(
+            wraps=template.NestedDictList._NestedDictList__items_converted)
+        with mock.patch.object(template.NestedDictList,
+                               '_NestedDictList__items_converted', walk):
+            self.assertEqual(len(query), 500)
+            for i in range(50):
+                query.set(f'service{i}.environment.PW', f'secret{i}')
+                query.set(f'service{i}.ports.80', str(9000+i))
+            for i in range(50):
+                self.assertEqual(query.get(f'service{i}.environment.PW'),
+                                 f'secret{i}')
+        self.assertEqual(walk.call_count, 1)